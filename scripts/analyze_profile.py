@@ -7,44 +7,335 @@ Analyzes samply profiling data to identify performance hotspots.
 Usage:
     python3 scripts/analyze_profile.py profile.json profile.syms.json
     python3 scripts/analyze_profile.py profile.json.gz profile.syms.json
+    python3 scripts/analyze_profile.py profile.json profile.syms.json --emit json
+    pypy3 scripts/analyze_profile.py profile.json profile.syms.json
 
 This script is called after profiling with:
     samply record --save-only target/release/demo-interactive
     
-Output shows top hotspots and key fire simulation functions.
-Supports both plain JSON and gzip-compressed files.
+Output shows top hotspots and key fire simulation functions. With --emit json
+or --emit csv, per-function counts for every analyzed thread are written to
+stdout instead, for flamegraph or CI tooling; progress goes to stderr.
+Supports both plain JSON and gzip-compressed files. Uses orjson for faster
+parsing and pigz for faster decompression when they are installed. With ijson
+installed, the profile is parsed incrementally and the main thread's text
+report is printed as soon as that thread has been read, before the rest of
+the profile is parsed. The script
+only needs the standard library, so it also runs under PyPy, whose JIT
+speeds up the per-stack loops on very large profiles.
+
+The extracted profile data is cached next to the profile in
+<profile>.cache, so later runs on the same files skip JSON parsing. The cache
+holds only JSON metadata and raw integer arrays, so loading one never
+executes code.
+
+Hotspots are ranked by self samples (the leaf frame of each sample); key
+functions and the summary use inclusive samples (anywhere on the stack,
+counted once per sample for recursive functions).
+
+The main thread is reported first, followed by every other thread with more
+than 100 samples (e.g. rayon workers), analyzed in parallel processes.
 """
 
+import argparse
+import csv
 import gzip
+import heapq
+import io
 import json
+import mmap
+import os
+import re
+import shutil
+import struct
+import subprocess
 import sys
-from collections import defaultdict
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def load_profile_data(profile_path, symbols_path):
-    """Load profile and symbol data. Automatically handles gzip compression."""
-    # Load profile (may be gzipped)
-    if str(profile_path).endswith('.gz'):
-        with gzip.open(profile_path, 'rt', encoding='utf-8') as f:
-            profile = json.load(f)
-    else:
-        with open(profile_path, 'r') as f:
-            profile = json.load(f)
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Threads with this many samples or fewer are not worth reporting
+MIN_THREAD_SAMPLES = 100
+
+# Bump when the cached data layout changes
+CACHE_VERSION = 7
+CACHE_MAGIC = b'analyze_profile cache\n'
+
+# Symbol name substrings that qualify a function for the hotspot table
+HOTSPOT_KEYWORDS = ['fire_sim_core', 'hashbrown', 'rayon', 'core::iter', 'alloc::vec', 'core::slice']
+HOTSPOT_PATTERN = re.compile('|'.join(re.escape(kw) for kw in HOTSPOT_KEYWORDS))
+
+# Key fire simulation functions to track
+KEY_FUNCTIONS = [
+    ('fire_sim_core::simulation::FireSimulation::update', 'UPDATE'),
+    ('fire_sim_core::grid::simulation_grid::SimulationGrid::mark_active_cells', 'MARK_ACTIVE'),
+    ('fire_sim_core::grid::simulation_grid::SimulationGrid::update_diffusion', 'DIFFUSION'),
+    ('fire_sim_core::core_types::spatial::SpatialIndex::query_radius', 'QUERY_RADIUS'),
+    ('fire_sim_core::physics::element_heat_transfer::calculate_total_heat_transfer', 'HEAT_XFER'),
+    ('core::iter::range::<impl core::iter::traits::iterator::Iterator for core::ops::range::Range<A>>::next', 'RANGE_NEXT'),
+    ('<core::ops::range::Range<T> as core::iter::range::RangeIteratorImpl>::spec_next', 'SPEC_NEXT'),
+    ('hashbrown::raw::RawTableInner::find_or_find_insert_slot_inner', 'HASHMAP_FIND'),
+    ('rayon::iter::extend::<impl rayon::iter::ParallelExtend<T> for alloc::vec::Vec<T>>::par_extend', 'PAR_EXTEND'),
+    ('<core::slice::iter::Iter<T> as core::iter::traits::iterator::Iterator>::next', 'SLICE_ITER'),
+    ('alloc::vec::Vec<T,A>::push', 'VEC_PUSH'),
+]
+
+
+def log(message):
+    """Print progress and diagnostics to stderr, keeping stdout for results."""
+    print(message, file=sys.stderr)
+
+
+def read_gzip(path):
+    """Decompress a gzip file, using pigz when it is on PATH."""
+    pigz = shutil.which('pigz')
+    if pigz:
+        # pigz reads, decompresses and checksums on separate threads
+        result = subprocess.run([pigz, '-dc', str(path)], stdout=subprocess.PIPE)
+        if result.returncode == 0:
+            return result.stdout
+        log(f"  WARNING: pigz failed on {path}, falling back to gzip module")
+    return gzip.decompress(Path(path).read_bytes())
+
+
+def load_json(path):
+    """Parse a JSON file from raw bytes. Automatically handles gzip compression."""
+    if str(path).endswith('.gz'):
+        data = read_gzip(path)
+        return orjson.loads(data) if orjson else json.loads(data)
     
-    # Load symbols (may be gzipped)
-    if str(symbols_path).endswith('.gz'):
-        with gzip.open(symbols_path, 'rt', encoding='utf-8') as f:
-            symbols = json.load(f)
-    else:
-        with open(symbols_path, 'r') as f:
-            symbols = json.load(f)
+    with open(path, 'rb') as f:
+        if not orjson:
+            return json.loads(f.read())
+        # Parse straight from the page cache without copying into a bytes object
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+
+
+def iter_profile_threads(profile_path):
+    """Yield the threads of a profile, extracted by extract_thread().
+
+    With ijson, each thread is yielded as soon as it has been parsed, so work
+    on the first threads can start while the rest of the file is still being
+    read. Otherwise the whole profile is parsed first and only the extracted
+    threads are kept.
+    """
+    if ijson:
+        opener = gzip.open if str(profile_path).endswith('.gz') else open
+        with opener(profile_path, 'rb') as f:
+            for thread in ijson.items(f, 'threads.item', use_float=True):
+                yield extract_thread(thread)
+        return
     
-    return profile, symbols
+    profile = load_json(profile_path)
+    threads = [extract_thread(thread) for thread in profile['threads']]
+    del profile
+    yield from threads
+
+
+def _int_array(values):
+    """Pack a JSON list of ints into a compact array, mapping None to -1."""
+    return array('q', (-1 if v is None else v for v in values))
+
+
+def extract_thread(thread):
+    """Extract the fields needed for analysis from a profile thread.
+
+    Index tables are packed into int arrays instead of lists of Python ints.
+    The frame and address tables are replaced by a per-stack function id
+    array in resolve_thread_stacks() once the address map is built.
+    """
+    return {
+        'name': thread.get('name', ''),
+        'processName': thread.get('processName', ''),
+        'isMainThread': thread.get('isMainThread', False),
+        'samples': _int_array(thread['samples']['stack']),
+        'prefix': _int_array(thread['stackTable']['prefix']),
+        'frame': _int_array(thread['stackTable']['frame']),
+        'address': _int_array(thread['frameTable']['address']),
+    }
+
+
+def cache_path_for(profile_path):
+    """Return the sidecar cache path for a profile."""
+    return profile_path.with_name(profile_path.name + '.cache')
+
+
+def _cache_key(profile_path, symbols_path):
+    """Identify the source files by path, modification time and size.
+
+    Arrays are stored in native byte order, so that is part of the key too.
+    """
+    key = [CACHE_VERSION, sys.byteorder]
+    for path in (profile_path, symbols_path):
+        stat = path.stat()
+        key.append([str(path.resolve()), stat.st_mtime_ns, stat.st_size])
+    return key
+
+
+def _write_block(f, obj):
+    """Write a length-prefixed JSON block."""
+    data = json.dumps(obj).encode('utf-8')
+    f.write(struct.pack('<Q', len(data)))
+    f.write(data)
+
+
+def _read_block(f):
+    """Read a block written by _write_block."""
+    (size,) = struct.unpack('<Q', f.read(8))
+    if size > os.fstat(f.fileno()).st_size - f.tell():
+        raise EOFError('truncated cache block')
+    return json.loads(f.read(size))
+
+
+def _cache_arrays(threads, address_map):
+    """List the arrays stored in the cache, in file order."""
+    arrays = [address_map['starts'], address_map['ends'], address_map['func_ids']]
+    for thread in threads:
+        arrays += [thread['samples'], thread['prefix'], thread['stack_func']]
+    return arrays
+
+
+def load_cache(profile_path, symbols_path):
+    """Return cached (threads, address_map), or None if missing or stale.
+
+    The cache is CACHE_MAGIC and a JSON key block, checked before anything
+    else is read, then a JSON metadata block and the raw arrays listed by
+    _cache_arrays. A cache that fails _check_cached_data is ignored.
+    """
+    try:
+        with open(cache_path_for(profile_path), 'rb') as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                raise ValueError('not an analyze_profile cache')
+            if _read_block(f) != _cache_key(profile_path, symbols_path):
+                return None
+            meta = _read_block(f)
+            
+            lengths = iter(meta['array_lengths'])
+            
+            def read_array(typecode):
+                values = array(typecode)
+                values.fromfile(f, next(lengths))
+                return values
+            
+            names = meta['names']
+            address_map = {
+                'starts': read_array('Q'),
+                'ends': read_array('Q'),
+                'func_ids': read_array('q'),
+                'names': names,
+                'name_ids': {name: func_id for func_id, name in enumerate(names)},
+            }
+            threads = [
+                {
+                    'name': thread['name'],
+                    'processName': thread['processName'],
+                    'isMainThread': thread['isMainThread'],
+                    'samples': read_array('q'),
+                    'prefix': read_array('q'),
+                    'stack_func': read_array('q'),
+                    'unknown_names': thread['unknown_names'],
+                }
+                for thread in meta['threads']
+            ]
+        _check_cached_data(threads, address_map)
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, KeyError, StopIteration, TypeError, ValueError, struct.error) as e:
+        log(f"  Ignoring unreadable cache: {e!r}")
+        return None
+    
+    return threads, address_map
+
+
+def _is_str_list(values):
+    return isinstance(values, list) and all(isinstance(v, str) for v in values)
+
+
+def _check_cached_data(threads, address_map):
+    """Raise ValueError unless cached data is consistent enough to analyze.
+
+    Catches corruption here rather than as an IndexError deep in the analysis.
+    """
+    names = address_map['names']
+    if not _is_str_list(names):
+        raise ValueError('corrupt cache: symbol names')
+    func_ids = address_map['func_ids']
+    if not len(address_map['starts']) == len(address_map['ends']) == len(func_ids):
+        raise ValueError('corrupt cache: address map lengths')
+    if func_ids and not (min(func_ids) >= 0 and max(func_ids) < len(names)):
+        raise ValueError('corrupt cache: address map function ids')
+    
+    for thread in threads:
+        if not (isinstance(thread['name'], str) and isinstance(thread['processName'], str)
+                and _is_str_list(thread['unknown_names'])):
+            raise ValueError('corrupt cache: thread metadata')
+        prefix = thread['prefix']
+        stack_func = thread['stack_func']
+        num_funcs = len(names) + len(thread['unknown_names'])
+        if len(stack_func) != len(prefix):
+            raise ValueError('corrupt cache: stack table lengths')
+        if stack_func and not (min(stack_func) >= 0 and max(stack_func) < num_funcs):
+            raise ValueError('corrupt cache: stack function ids')
+        if not all(-1 <= p < i for i, p in enumerate(prefix)):
+            raise ValueError('corrupt cache: stack prefixes')
+        if thread['samples'] and max(thread['samples']) >= len(prefix):
+            raise ValueError('corrupt cache: sample stack indices')
+
+
+def save_cache(profile_path, symbols_path, threads, address_map):
+    """Write extracted profile data to the sidecar cache."""
+    cache_path = cache_path_for(profile_path)
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    arrays = _cache_arrays(threads, address_map)
+    meta = {
+        'names': address_map['names'],
+        'threads': [
+            {
+                'name': thread['name'],
+                'processName': thread['processName'],
+                'isMainThread': thread['isMainThread'],
+                'unknown_names': thread['unknown_names'],
+            }
+            for thread in threads
+        ],
+        'array_lengths': [len(values) for values in arrays],
+    }
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(CACHE_MAGIC)
+            _write_block(f, _cache_key(profile_path, symbols_path))
+            _write_block(f, meta)
+            for values in arrays:
+                values.tofile(f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log(f"  WARNING: Could not write cache {cache_path}: {e}")
+        tmp_path.unlink(missing_ok=True)
 
 
 def build_address_map(symbols):
-    """Build mapping from address to symbol name for demo-interactive."""
+    """Build sorted symbol ranges for demo-interactive.
+
+    Each distinct string table entry gets an integer function id. Symbol
+    ranges are flattened into disjoint segments (see _flatten_ranges). Returns
+    a dict with parallel 'starts', 'ends' and 'func_ids' arrays sorted by
+    start address, plus 'names' (id -> name) and 'name_ids' (name -> id).
+    """
     demo_lib = None
     for lib in symbols['data']:
         if 'demo-interactive' in lib.get('debug_name', ''):
@@ -52,125 +343,339 @@ def build_address_map(symbols):
             break
     
     if not demo_lib:
-        print("ERROR: Could not find demo-interactive library in symbols")
+        log("ERROR: Could not find demo-interactive library in symbols")
         sys.exit(1)
     
-    addr_to_sym = {}
+    # Key functions by string table index; names are only looked up once
+    # per distinct symbol
+    symbol_ids = {}
+    ranges = []
     for sym_entry in demo_lib['symbol_table']:
         rva = sym_entry['rva']
         size = sym_entry['size']
         symbol_idx = sym_entry['symbol']
-        symbol_name = symbols['string_table'][symbol_idx]
+        if size <= 0:
+            # Zero-size labels never own an address
+            continue
+        
+        func_id = symbol_ids.get(symbol_idx)
+        if func_id is None:
+            func_id = symbol_ids[symbol_idx] = len(symbol_ids)
+        ranges.append((rva, rva + size, func_id))
+    
+    string_table = symbols['string_table']
+    names = [string_table[symbol_idx] for symbol_idx in symbol_ids]
+    
+    segments = _flatten_ranges(ranges)
+    return {
+        'starts': array('Q', (seg[0] for seg in segments)),
+        'ends': array('Q', (seg[1] for seg in segments)),
+        'func_ids': array('q', (seg[2] for seg in segments)),
+        'names': names,
+        'name_ids': {name: func_id for func_id, name in enumerate(names)},
+    }
+
+
+def _flatten_ranges(ranges):
+    """Split possibly nested or overlapping ranges into disjoint segments.
+
+    ranges holds (start, end, func_id) in symbol table order. Where ranges
+    overlap, the later entry owns the overlap, as it did when every byte was
+    mapped individually; once a nested range ends, the range around it owns
+    the addresses again. Returns [start, end, func_id] segments sorted by
+    start, with adjacent segments of the same function merged.
+    """
+    by_start = sorted(
+        (start, end, order, func_id) for order, (start, end, func_id) in enumerate(ranges)
+    )
+    boundaries = sorted({r[0] for r in by_start} | {r[1] for r in by_start})
+    
+    segments = []
+    active = []  # heap of (-order, end, func_id); the latest entry is on top
+    next_range = 0
+    for seg_start, seg_end in zip(boundaries, boundaries[1:]):
+        while next_range < len(by_start) and by_start[next_range][0] <= seg_start:
+            _, end, order, func_id = by_start[next_range]
+            heapq.heappush(active, (-order, end, func_id))
+            next_range += 1
+        # Ranges that ended are dropped lazily once they reach the top
+        while active and active[0][1] <= seg_start:
+            heapq.heappop(active)
+        if not active:
+            continue
         
-        # Map all addresses in this range
-        for offset in range(size):
-            addr_to_sym[rva + offset] = symbol_name
+        func_id = active[0][2]
+        if segments and segments[-1][1] == seg_start and segments[-1][2] == func_id:
+            segments[-1][1] = seg_end
+        else:
+            segments.append([seg_start, seg_end, func_id])
+    return segments
+
+
+def resolve_func_ids(address_map, addrs):
+    """Resolve an array of addresses to function ids, -1 where unknown.
+
+    Each distinct address is binary-searched once.
+    """
+    starts = address_map['starts']
+    ends = address_map['ends']
+    func_ids = address_map['func_ids']
+    
+    resolved = {}
+    for addr in set(addrs):
+        idx = bisect_right(starts, addr) - 1
+        resolved[addr] = func_ids[idx] if idx >= 0 and addr < ends[idx] else -1
+    return array('q', map(resolved.__getitem__, addrs))
+
+
+def resolve_thread_stacks(thread, address_map):
+    """Replace a thread's frame and address tables with per-stack function ids.
+
+    Returns a thread record whose 'stack_func' array gives the function id of
+    each stack table entry, i.e. address[frame[stack]] resolved once. Addresses
+    outside any known symbol get ids after the symbol ids, named by hex
+    address in 'unknown_names'.
+    """
+    num_symbols = len(address_map['names'])
+    unknown_names = []
+    unknown_ids = {}
+    frame_addresses = thread['address']
+    
+    frame_func_ids = resolve_func_ids(address_map, frame_addresses)
+    for frame_idx, func_id in enumerate(frame_func_ids):
+        if func_id < 0:
+            addr = frame_addresses[frame_idx]
+            func_id = unknown_ids.get(addr)
+            if func_id is None:
+                func_id = unknown_ids[addr] = num_symbols + len(unknown_names)
+                unknown_names.append(f'0x{addr:x}')
+            frame_func_ids[frame_idx] = func_id
     
-    return addr_to_sym
+    return {
+        'name': thread['name'],
+        'processName': thread['processName'],
+        'isMainThread': thread['isMainThread'],
+        'samples': thread['samples'],
+        'prefix': thread['prefix'],
+        'stack_func': array('q', map(frame_func_ids.__getitem__, thread['frame'])),
+        'unknown_names': unknown_names,
+    }
+
 
+def is_main_thread(thread):
+    """Return True if a thread is a main thread with actual samples."""
+    if 'demo-interactive' in thread['processName'] or thread['isMainThread']:
+        return len(thread['samples']) > MIN_THREAD_SAMPLES
+    return False
 
-def find_main_thread(profile):
+
+def find_main_thread(threads):
     """Find the main thread with actual samples."""
-    for thread in profile['threads']:
-        if 'demo-interactive' in thread.get('processName', '') or thread.get('isMainThread'):
-            if thread['samples']['length'] > 100:
-                return thread
+    for thread in threads:
+        if is_main_thread(thread):
+            return thread
     
     # Fallback: find thread with most samples
-    return max(profile['threads'], key=lambda t: t['samples']['length'])
+    return max(threads, key=lambda t: len(t['samples']))
+
+
+def select_threads(threads):
+    """Select threads to analyze: the main thread, then other busy threads."""
+    main_thread = find_main_thread(threads)
+    return [main_thread] + [
+        thread for thread in threads
+        if thread is not main_thread and len(thread['samples']) > MIN_THREAD_SAMPLES
+    ]
+
+
+def analyze_samples(thread, num_symbols):
+    """Count self and inclusive samples per function.
 
+    Self samples go to the leaf frame of each sample; inclusive samples go to
+    every function on its stack, once per sample even when it recurses. Samples are tallied per stack table entry, whose
+    function ids were precomputed by resolve_thread_stacks(). Inclusive
+    counts then come from a single leaf-to-root pass over the stack table, so
+    no stack is walked per sample.
 
-def analyze_samples(thread, addr_to_sym):
-    """Count samples per function by walking stacks."""
-    func_samples = defaultdict(int)
-    stack_indices = thread['samples']['stack']
+    Returns (self_samples, inclusive_samples, unknown_names, total_samples),
+    where the sample arrays are indexed by function id.
+    """
+    stack_indices = thread['samples']
+    stack_prefixes = thread['prefix']
+    unknown_names = thread['unknown_names']
     
-    for stack_idx in stack_indices:
-        if stack_idx is None or stack_idx < 0:
+    # Samples whose leaf is each stack table entry
+    num_stacks = len(stack_prefixes)
+    stack_samples = array('q', bytes(8 * num_stacks))
+    for stack_idx, count in Counter(stack_indices).items():
+        if stack_idx >= 0:
+            stack_samples[stack_idx] = count
+    
+    self_samples, inclusive_samples = accumulate_stack_samples(
+        stack_samples, stack_prefixes, thread['stack_func'], num_symbols + len(unknown_names))
+    
+    return self_samples, inclusive_samples, unknown_names, len(stack_indices)
+
+
+def accumulate_stack_samples(stack_samples, stack_prefixes, stack_func_ids, num_funcs):
+    """Fold per-stack sample counts into per-function self and inclusive counts.
+
+    A recursive function only counts the subtree of its outermost frame, so
+    its inclusive share never exceeds the samples it appears in.
+
+    Kept as a flat loop over int arrays with no closures or dict lookups, the
+    shape PyPy's tracing JIT compiles best.
+    """
+    self_samples = array('q', bytes(8 * num_funcs))
+    inclusive_samples = array('q', bytes(8 * num_funcs))
+    recursive = recursive_stacks(stack_prefixes, stack_func_ids, num_funcs)
+    
+    # A prefix always has a lower index than its stack, so walking indices
+    # downwards visits every stack after all of its descendants
+    subtree_samples = array('q', stack_samples)
+    for stack_idx in range(len(stack_samples) - 1, -1, -1):
+        count = subtree_samples[stack_idx]
+        if count == 0:
             continue
         
-        # Walk up the stack (limit depth to avoid infinite loops)
-        current = stack_idx
-        visited = set()
+        func_id = stack_func_ids[stack_idx]
+        self_samples[func_id] += stack_samples[stack_idx]
+        if not recursive[stack_idx]:
+            inclusive_samples[func_id] += count
         
-        for depth in range(50):
-            if current is None or current < 0:
-                break
-            
-            if current in visited:
-                break
-            visited.add(current)
-            
-            frame_idx = thread['stackTable']['frame'][current]
-            addr = thread['frameTable']['address'][frame_idx]
-            
-            # Look up symbol name
-            func_name = addr_to_sym.get(addr, f'0x{addr:x}')
-            func_samples[func_name] += 1
-            
-            # Get parent stack frame
-            current = thread['stackTable']['prefix'][current]
+        prefix = stack_prefixes[stack_idx]
+        if prefix >= 0:
+            subtree_samples[prefix] += count
     
-    return func_samples, len(stack_indices)
+    return self_samples, inclusive_samples
 
 
-def print_analysis(func_samples, total_samples):
-    """Print hotspot analysis."""
-    print(f'Total samples: {total_samples}\n')
+def recursive_stacks(stack_prefixes, stack_func_ids, num_funcs):
+    """Flag stack table entries whose function already appears in an ancestor.
+
+    Walks the stack tree depth-first once, keeping a per-function count of the
+    frames on the current path, so the cost is linear in the table size.
+    """
+    num_stacks = len(stack_prefixes)
     
-    # Key fire simulation functions to track
-    key_functions = [
-        ('fire_sim_core::simulation::FireSimulation::update', 'UPDATE'),
-        ('fire_sim_core::grid::simulation_grid::SimulationGrid::mark_active_cells', 'MARK_ACTIVE'),
-        ('fire_sim_core::grid::simulation_grid::SimulationGrid::update_diffusion', 'DIFFUSION'),
-        ('fire_sim_core::core_types::spatial::SpatialIndex::query_radius', 'QUERY_RADIUS'),
-        ('fire_sim_core::physics::element_heat_transfer::calculate_total_heat_transfer', 'HEAT_XFER'),
-        ('core::iter::range::<impl core::iter::traits::iterator::Iterator for core::ops::range::Range<A>>::next', 'RANGE_NEXT'),
-        ('<core::ops::range::Range<T> as core::iter::range::RangeIteratorImpl>::spec_next', 'SPEC_NEXT'),
-        ('hashbrown::raw::RawTableInner::find_or_find_insert_slot_inner', 'HASHMAP_FIND'),
-        ('rayon::iter::extend::<impl rayon::iter::ParallelExtend<T> for alloc::vec::Vec<T>>::par_extend', 'PAR_EXTEND'),
-        ('<core::slice::iter::Iter<T> as core::iter::traits::iterator::Iterator>::next', 'SLICE_ITER'),
-        ('alloc::vec::Vec<T,A>::push', 'VEC_PUSH'),
-    ]
+    # Children of each stack, laid out contiguously by parent
+    child_start = array('q', bytes(8 * (num_stacks + 2)))
+    for stack_idx in range(num_stacks):
+        prefix = stack_prefixes[stack_idx]
+        if prefix >= stack_idx:
+            raise ValueError(f"stack table is not prefix-ordered at stack {stack_idx}")
+        child_start[prefix + 1] += 1
+    # child_start[0] now counts the roots; shift to running offsets
+    offset = 0
+    for slot in range(num_stacks + 2):
+        offset, child_start[slot] = offset + child_start[slot], offset
+    children = array('q', bytes(8 * num_stacks))
+    fill = array('q', child_start)
+    for stack_idx in range(num_stacks):
+        slot = stack_prefixes[stack_idx] + 1
+        children[fill[slot]] = stack_idx
+        fill[slot] += 1
+    
+    recursive = bytearray(num_stacks)
+    on_path = array('q', bytes(8 * num_funcs))
+    # Entries are pushed as ~stack_idx to mark leaving that stack
+    pending = list(children[child_start[0]:child_start[1]])
+    while pending:
+        stack_idx = pending.pop()
+        if stack_idx < 0:
+            on_path[stack_func_ids[~stack_idx]] -= 1
+            continue
+        
+        func_id = stack_func_ids[stack_idx]
+        if on_path[func_id]:
+            recursive[stack_idx] = 1
+        on_path[func_id] += 1
+        pending.append(~stack_idx)
+        pending.extend(children[child_start[stack_idx + 1]:child_start[stack_idx + 2]])
+    
+    return recursive
+
+
+def analyze_threads(threads, num_symbols):
+    """Yield analyze_samples results for each thread, in order.
+
+    The first thread is analyzed in this process while the others run in
+    worker processes, so its result is available without waiting for them.
+    """
+    if len(threads) <= 1:
+        yield from (analyze_samples(thread, num_symbols) for thread in threads)
+        return
+    
+    with ProcessPoolExecutor(max_workers=min(len(threads) - 1, os.cpu_count() or 1)) as executor:
+        pending = executor.map(partial(analyze_samples, num_symbols=num_symbols), threads[1:])
+        yield analyze_samples(threads[0], num_symbols)
+        yield from pending
+
+
+def resolve_key_functions(address_map):
+    """Return (func_id, func_name, label) for KEY_FUNCTIONS, func_id -1 if absent."""
+    name_ids = address_map['name_ids']
+    return [(name_ids.get(func_name, -1), func_name, label) for func_name, label in KEY_FUNCTIONS]
+
+
+def hotspot_mask(address_map):
+    """Return a per-function-id mask, 1 where the name matches HOTSPOT_KEYWORDS.
+
+    Computed on every run rather than cached, so edits to HOTSPOT_KEYWORDS
+    take effect immediately.
+    """
+    return bytearray(HOTSPOT_PATTERN.search(name) is not None for name in address_map['names'])
+
+
+def print_analysis(self_samples, inclusive_samples, address_map, key_functions, hotspot, total_samples):
+    """Print hotspot analysis from per-function-id sample counts.
+
+    key_functions comes from resolve_key_functions() and hotspot from
+    hotspot_mask(). Ids past the mask are unknown addresses, which never
+    match.
+    """
+    func_names = address_map['names']
+    
+    # Percentage of total samples per sample, computed once
+    pct_scale = 100.0 / total_samples if total_samples > 0 else 0.0
+    
+    print(f'Total samples: {total_samples}\n')
     
     print('=' * 80)
-    print('KEY FIRE SIMULATION FUNCTIONS')
+    print('KEY FIRE SIMULATION FUNCTIONS (inclusive samples)')
     print('=' * 80)
-    for func_name, label in key_functions:
-        count = func_samples.get(func_name, 0)
-        pct = (count / total_samples * 100) if total_samples > 0 else 0
+    key_pcts = {}
+    for func_id, func_name, label in key_functions:
+        count = inclusive_samples[func_id] if func_id >= 0 else 0
+        pct = key_pcts[label] = count * pct_scale
         if count > 0:
             print(f'{pct:5.1f}%  {count:6d}  {label:20s} {func_name}')
     
     print('\n' + '=' * 80)
-    print('TOP 40 HOTSPOTS (fire_sim_core, hashbrown, rayon, core::iter)')
+    print('TOP 40 HOTSPOTS BY SELF SAMPLES (fire_sim_core, hashbrown, rayon, core::iter)')
     print('=' * 80)
     
-    # Filter and sort hotspots
-    sorted_funcs = sorted(func_samples.items(), key=lambda x: -x[1])
-    
-    keywords = ['fire_sim_core', 'hashbrown', 'rayon', 'core::iter', 'alloc::vec', 'core::slice']
+    # Filter with the keyword mask, then keep only the top 40 by sample count
+    top_ids = heapq.nlargest(
+        40,
+        (func_id for func_id in range(len(hotspot)) if hotspot[func_id] and self_samples[func_id] > 0),
+        key=self_samples.__getitem__,
+    )
     
-    count_shown = 0
-    for func_name, count in sorted_funcs:
-        if count_shown >= 40:
-            break
-        
-        if any(kw in func_name for kw in keywords):
-            pct = (count / total_samples * 100)
-            print(f'{pct:5.1f}%  {count:6d}  {func_name}')
-            count_shown += 1
+    for func_id in top_ids:
+        count = self_samples[func_id]
+        print(f'{count * pct_scale:5.1f}%  {count:6d}  {func_names[func_id]}')
     
     print('\n' + '=' * 80)
-    print('PERFORMANCE SUMMARY')
+    print('PERFORMANCE SUMMARY (inclusive samples)')
     print('=' * 80)
     
     # Calculate key metrics
-    update_pct = func_samples.get('fire_sim_core::simulation::FireSimulation::update', 0) / total_samples * 100
-    mark_pct = func_samples.get('fire_sim_core::grid::simulation_grid::SimulationGrid::mark_active_cells', 0) / total_samples * 100
-    diff_pct = func_samples.get('fire_sim_core::grid::simulation_grid::SimulationGrid::update_diffusion', 0) / total_samples * 100
-    query_pct = func_samples.get('fire_sim_core::core_types::spatial::SpatialIndex::query_radius', 0) / total_samples * 100
-    par_extend_pct = func_samples.get('rayon::iter::extend::<impl rayon::iter::ParallelExtend<T> for alloc::vec::Vec<T>>::par_extend', 0) / total_samples * 100
+    update_pct = key_pcts['UPDATE']
+    mark_pct = key_pcts['MARK_ACTIVE']
+    diff_pct = key_pcts['DIFFUSION']
+    query_pct = key_pcts['QUERY_RADIUS']
+    par_extend_pct = key_pcts['PAR_EXTEND']
     
     print(f'Update:          {update_pct:5.1f}%  (Main simulation loop)')
     print(f'Query Radius:    {query_pct:5.1f}%  (Spatial neighbor searches)')
@@ -195,39 +700,160 @@ def print_analysis(func_samples, total_samples):
     print()
 
 
+def print_thread_report(thread, result, address_map, key_functions, hotspot):
+    """Print the text report for one thread from its analyze_samples() result."""
+    self_samples, inclusive_samples, _, total_samples = result
+    print("\n")
+    print(f"THREAD: {thread['name']}")
+    print_analysis(self_samples, inclusive_samples, address_map, key_functions, hotspot, total_samples)
+    sys.stdout.flush()
+
+
+def function_rows(self_samples, inclusive_samples, unknown_names, address_map, total_samples):
+    """Return (name, self, inclusive, self_pct, inclusive_pct) for every sampled function.
+
+    Rows are sorted by self samples, then inclusive samples, descending.
+    """
+    names = address_map['names']
+    pct_scale = 100.0 / total_samples if total_samples > 0 else 0.0
+    rows = []
+    for func_id, inclusive in enumerate(inclusive_samples):
+        if inclusive == 0:
+            continue
+        name = names[func_id] if func_id < len(names) else unknown_names[func_id - len(names)]
+        count = self_samples[func_id]
+        rows.append((name, count, inclusive, count * pct_scale, inclusive * pct_scale))
+    rows.sort(key=lambda row: (-row[1], -row[2]))
+    return rows
+
+
+def emit_json(reports):
+    """Write per-thread function counts to stdout as one JSON document."""
+    result = {
+        'threads': [
+            {
+                'name': name,
+                'total': total_samples,
+                'per_function': [
+                    {
+                        'name': func_name,
+                        'self': count,
+                        'inclusive': inclusive,
+                        'self_pct': self_pct,
+                        'inclusive_pct': inclusive_pct,
+                    }
+                    for func_name, count, inclusive, self_pct, inclusive_pct in rows
+                ],
+            }
+            for name, total_samples, rows in reports
+        ],
+    }
+    if orjson:
+        sys.stdout.buffer.write(orjson.dumps(result) + b'\n')
+    else:
+        sys.stdout.write(json.dumps(result) + '\n')
+
+
+def emit_csv(reports):
+    """Write per-thread function counts to stdout as CSV."""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['thread', 'function', 'self', 'inclusive', 'self_pct', 'inclusive_pct'])
+    for name, _, rows in reports:
+        for func_name, count, inclusive, self_pct, inclusive_pct in rows:
+            writer.writerow([name, func_name, count, inclusive, f'{self_pct:.3f}', f'{inclusive_pct:.3f}'])
+    sys.stdout.write(out.getvalue())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('profile', type=Path, help='samply profile (profile.json[.gz])')
+    parser.add_argument('symbols', type=Path, help='samply symbols (profile.syms.json[.gz])')
+    parser.add_argument(
+        '--emit',
+        choices=['text', 'json', 'csv'],
+        default='text',
+        help='output format (default: text report)',
+    )
+    return parser.parse_args()
+
+
 def main():
-    if len(sys.argv) != 3:
-        print(__doc__)
-        print(f"\nUsage: {sys.argv[0]} <profile.json[.gz]> <profile.syms.json[.gz]>")
-        sys.exit(1)
-    
-    profile_path = Path(sys.argv[1])
-    symbols_path = Path(sys.argv[2])
+    args = parse_args()
+    profile_path = args.profile
+    symbols_path = args.symbols
     
     if not profile_path.exists():
-        print(f"ERROR: Profile file not found: {profile_path}")
+        log(f"ERROR: Profile file not found: {profile_path}")
         sys.exit(1)
     
     if not symbols_path.exists():
-        print(f"ERROR: Symbols file not found: {symbols_path}")
+        log(f"ERROR: Symbols file not found: {symbols_path}")
         sys.exit(1)
     
-    print("Loading profile data...")
-    profile, symbols = load_profile_data(profile_path, symbols_path)
+    cached = load_cache(profile_path, symbols_path)
+    if cached:
+        log(f"Loading cached profile data from {cache_path_for(profile_path)}...")
+        threads, address_map = cached
+        profile_threads = None
+    else:
+        log("Building address map...")
+        # Only the address map is needed from here on; the symbols DOM is
+        # released before the profile is parsed and worker processes forked
+        address_map = build_address_map(load_json(symbols_path))
+        profile_threads = iter_profile_threads(profile_path)
+    log(f"  Loaded {len(address_map['starts'])} symbol ranges")
     
-    print("Building address map...")
-    addr_to_sym = build_address_map(symbols)
-    print(f"  Loaded {len(addr_to_sym)} address mappings")
+    num_symbols = len(address_map['names'])
+    key_functions = resolve_key_functions(address_map)
+    hotspot = hotspot_mask(address_map)
     
-    print("Finding main thread...")
-    main_thread = find_main_thread(profile)
-    print(f"  Thread: {main_thread['name']}, Samples: {main_thread['samples']['length']}")
+    reported = None
+    if profile_threads is not None:
+        log("Loading profile data...")
+        threads = []
+        for thread in profile_threads:
+            thread = resolve_thread_stacks(thread, address_map)
+            threads.append(thread)
+            # find_main_thread() picks the first qualifying thread, so it can
+            # be reported while the rest of the profile is still being parsed
+            if args.emit == 'text' and reported is None and is_main_thread(thread):
+                log(f"  Main thread: {thread['name']}, Samples: {len(thread['samples'])}")
+                print_thread_report(thread, analyze_samples(thread, num_symbols),
+                                    address_map, key_functions, hotspot)
+                reported = thread
+        save_cache(profile_path, symbols_path, threads, address_map)
     
-    print("\nAnalyzing samples...")
-    func_samples, total_samples = analyze_samples(main_thread, addr_to_sym)
+    log("Selecting threads...")
+    selected = select_threads(threads)
+    del threads
+    if reported is not None:
+        selected = [thread for thread in selected if thread is not reported]
+    for thread in selected:
+        log(f"  Thread: {thread['name']}, Samples: {len(thread['samples'])}")
     
-    print("\n")
-    print_analysis(func_samples, total_samples)
+    log("\nAnalyzing samples...")
+    results = analyze_threads(selected, num_symbols)
+    
+    if args.emit != 'text':
+        reports = [
+            (thread['name'], total_samples,
+             function_rows(self_samples, inclusive_samples, unknown_names, address_map, total_samples))
+            for thread, (self_samples, inclusive_samples, unknown_names, total_samples) in zip(selected, results)
+        ]
+        if args.emit == 'json':
+            emit_json(reports)
+        else:
+            emit_csv(reports)
+        return
+    
+    # Print each report as soon as its thread is done; the main thread comes
+    # first and is not held back by the worker threads
+    for thread, result in zip(selected, results):
+        print_thread_report(thread, result, address_map, key_functions, hotspot)
 
 
 if __name__ == '__main__':
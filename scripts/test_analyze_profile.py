@@ -0,0 +1,187 @@
+"""
+Regression checks for analyze_profile.py.
+
+Run with:
+    python3 -m unittest discover scripts
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+from array import array
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import analyze_profile  # noqa: E402
+
+UPDATE = 'fire_sim_core::simulation::FireSimulation::update'
+
+
+def make_symbols(symbol_table, string_table):
+    return {
+        'string_table': string_table,
+        'data': [{'debug_name': 'demo-interactive', 'symbol_table': symbol_table}],
+    }
+
+
+def resolve(address_map, addrs):
+    names = address_map['names']
+    return [names[i] if i >= 0 else None for i in analyze_profile.resolve_func_ids(address_map, array('q', addrs))]
+
+
+class AddressMapTest(unittest.TestCase):
+    def test_zero_size_label_does_not_hide_enclosing_function(self):
+        symbols = make_symbols(
+            [
+                {'rva': 0x400, 'size': 0x100, 'symbol': 0},
+                {'rva': 0x401, 'size': 0, 'symbol': 1},
+            ],
+            [UPDATE, 'label'],
+        )
+        address_map = analyze_profile.build_address_map(symbols)
+        
+        self.assertEqual(resolve(address_map, [0x400, 0x401, 0x470, 0x4ff, 0x500]),
+                         [UPDATE, UPDATE, UPDATE, UPDATE, None])
+        
+        # Key function and summary rows see the samples
+        thread = analyze_profile.resolve_thread_stacks({
+            'name': 'main', 'processName': 'demo-interactive', 'isMainThread': True,
+            'samples': array('q', [0, 0, 0]),
+            'prefix': array('q', [-1]),
+            'frame': array('q', [0]),
+            'address': array('q', [0x470]),
+        }, address_map)
+        _, inclusive, _, _ = analyze_profile.analyze_samples(thread, len(address_map['names']))
+        self.assertEqual(inclusive[address_map['name_ids'][UPDATE]], 3)
+    
+    def test_nested_and_overlapping_ranges(self):
+        symbols = make_symbols(
+            [
+                {'rva': 0x100, 'size': 0x100, 'symbol': 0},  # outer
+                {'rva': 0x120, 'size': 0x10, 'symbol': 1},   # nested in outer
+                {'rva': 0x1f0, 'size': 0x20, 'symbol': 2},   # overlaps outer's tail
+            ],
+            ['outer', 'inner', 'tail'],
+        )
+        address_map = analyze_profile.build_address_map(symbols)
+        
+        self.assertEqual(
+            resolve(address_map, [0x100, 0x120, 0x12f, 0x130, 0x1ef, 0x1f0, 0x20f, 0x210]),
+            ['outer', 'inner', 'inner', 'outer', 'outer', 'tail', 'tail', None],
+        )
+
+
+class SampleCountTest(unittest.TestCase):
+    def count(self, stacks, samples):
+        """Analyze a stack table given as (prefix, function id) pairs."""
+        thread = {
+            'samples': array('q', samples),
+            'prefix': array('q', [prefix for prefix, _ in stacks]),
+            'stack_func': array('q', [func for _, func in stacks]),
+            'unknown_names': [],
+        }
+        self_samples, inclusive, _, total = analyze_profile.analyze_samples(thread, 3)
+        return list(self_samples), list(inclusive), total
+    
+    def test_recursive_function_counts_once_per_sample(self):
+        # A -> B -> A
+        self_samples, inclusive, total = self.count([(-1, 0), (0, 1), (1, 0)], [2] * 10)
+        
+        self.assertEqual(self_samples, [10, 0, 0])
+        self.assertEqual(inclusive, [10, 10, 0])
+        self.assertLessEqual(max(inclusive), total)
+    
+    def test_branching_stacks(self):
+        # R -> X, R -> Y -> X and R -> Y
+        self_samples, inclusive, _ = self.count(
+            [(-1, 0), (0, 1), (0, 2), (2, 1)], [1] * 5 + [3] * 3 + [2] * 2)
+        
+        self.assertEqual(self_samples, [0, 8, 2])
+        self.assertEqual(inclusive, [10, 8, 5])
+
+
+class StreamingTest(unittest.TestCase):
+    @unittest.skipUnless(analyze_profile.ijson, 'ijson is not installed')
+    def test_first_thread_is_yielded_before_the_rest_is_parsed(self):
+        thread = (
+            '{"name": "main", "processName": "demo-interactive", "isMainThread": true,'
+            ' "samples": {"stack": [0, null]}, "stackTable": {"prefix": [null], "frame": [0]},'
+            ' "frameTable": {"address": [1024]}}'
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            # The second thread is cut off, as if it had not been read yet
+            path = Path(tmp) / 'profile.json'
+            path.write_text('{"threads": [' + thread + ', {"name": "worker", "samples": {"stack": [0, ')
+            
+            threads = analyze_profile.iter_profile_threads(path)
+            first = next(threads)
+            self.assertEqual(first['name'], 'main')
+            self.assertEqual(list(first['samples']), [0, -1])
+            self.assertEqual(list(first['address']), [1024])
+            with self.assertRaises(analyze_profile.ijson.IncompleteJSONError):
+                next(threads)
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.profile_path = Path(tmp.name) / 'profile.json'
+        self.symbols_path = Path(tmp.name) / 'profile.syms.json'
+        self.profile_path.write_text('{}')
+        self.symbols_path.write_text('{}')
+        
+        self.address_map = analyze_profile.build_address_map(make_symbols(
+            [{'rva': 0x400, 'size': 0x100, 'symbol': 0}], [UPDATE]))
+        self.threads = [analyze_profile.resolve_thread_stacks({
+            'name': 'main', 'processName': 'demo-interactive', 'isMainThread': True,
+            'samples': array('q', [0, -1, 1]),
+            'prefix': array('q', [-1, 0]),
+            'frame': array('q', [0, 1]),
+            'address': array('q', [0x470, 0x900]),
+        }, self.address_map)]
+    
+    def test_round_trip(self):
+        analyze_profile.save_cache(self.profile_path, self.symbols_path, self.threads, self.address_map)
+        
+        cached = analyze_profile.load_cache(self.profile_path, self.symbols_path)
+        self.assertEqual(cached, (self.threads, self.address_map))
+    
+    def test_stale_or_foreign_cache_is_ignored(self):
+        analyze_profile.save_cache(self.profile_path, self.symbols_path, self.threads, self.address_map)
+        stat = self.symbols_path.stat()
+        os.utime(self.symbols_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertIsNone(analyze_profile.load_cache(self.profile_path, self.symbols_path))
+        
+        analyze_profile.cache_path_for(self.profile_path).write_bytes(b'\x80\x04not a cache')
+        self.assertIsNone(analyze_profile.load_cache(self.profile_path, self.symbols_path))
+    
+    def write_raw_cache(self, meta, payload=b''):
+        with open(analyze_profile.cache_path_for(self.profile_path), 'wb') as f:
+            f.write(analyze_profile.CACHE_MAGIC)
+            analyze_profile._write_block(f, analyze_profile._cache_key(self.profile_path, self.symbols_path))
+            analyze_profile._write_block(f, meta)
+            f.write(payload)
+    
+    def test_corrupt_cache_with_valid_key_is_ignored(self):
+        self.write_raw_cache(['not', 'a', 'dict'])
+        self.assertIsNone(analyze_profile.load_cache(self.profile_path, self.symbols_path))
+        
+        self.write_raw_cache({'names': [UPDATE], 'threads': [], 'array_lengths': ['1', 1, 1]}, bytes(24))
+        self.assertIsNone(analyze_profile.load_cache(self.profile_path, self.symbols_path))
+        
+        self.threads[0]['stack_func'][0] = 99
+        analyze_profile.save_cache(self.profile_path, self.symbols_path, self.threads, self.address_map)
+        self.assertIsNone(analyze_profile.load_cache(self.profile_path, self.symbols_path))
+    
+    def test_failed_write_leaves_no_temp_file(self):
+        cache_path = analyze_profile.cache_path_for(self.profile_path)
+        cache_path.mkdir()
+        analyze_profile.save_cache(self.profile_path, self.symbols_path, self.threads, self.address_map)
+        self.assertEqual(list(self.profile_path.parent.glob('*.tmp')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()